@@ -21,13 +21,27 @@
 misc vcf utilities
 """
 
+from __future__ import absolute_import
+
+
+# read buffer size used for VCF input
+READ_BUFFER_SIZE = 1 << 22
+
 
 def openMaybeGzip(fileName):
+    """
+    Open a plain or gzipped text file for line iteration
+
+    Both file types are read in large blocks. GzipFile line iteration is otherwise
+    served through small reads from the decompressor, so it is wrapped in a
+    BufferedReader.
+    """
     import gzip
+    import io
     if fileName.endswith(".gz"):
-        return gzip.GzipFile(fileName)
+        return io.BufferedReader(gzip.GzipFile(fileName), READ_BUFFER_SIZE)
     else:
-        return open(fileName)
+        return open(fileName, "r", READ_BUFFER_SIZE)
 
 
 class VCFID :
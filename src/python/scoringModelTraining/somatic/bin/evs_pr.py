@@ -63,6 +63,25 @@ def parseArgs():
     return args
 
 
+def countAboveThresholds(values, thresholds):
+    """
+    Return two arrays with the number of values above, and at or below each threshold
+
+    NaN values are not counted in either array.
+    """
+    values = numpy.sort(values[~numpy.isnan(values)])
+    atOrBelow = numpy.searchsorted(values, thresholds, side="right")
+    return (len(values) - atOrBelow, atOrBelow)
+
+
+def ratioOrNaN(numerator, denominator):
+    """
+    Return numerator / denominator elementwise, or NaN where the denominator is zero
+    """
+    return numpy.divide(numerator, denominator.astype(numpy.float64),
+                        out=numpy.full(len(denominator), numpy.nan), where=(denominator != 0))
+
+
 def main():
     args = parseArgs()
 
@@ -133,37 +152,28 @@ def main():
             strelka_f_tps = 0
             strelka_f_fps = 0
 
-        counter = 0
-        for q in qual_vals[:-1]:
-            rec = {"field": f, "qual": q}
-            rec["tp"] = data_remaining[
-                (data_remaining["tag"] == "TP") & (data_remaining[f] > q)].shape[0]
-            rec["fp"] = data_remaining[
-                (data_remaining["tag"] == "FP") & (data_remaining[f] > q)].shape[0]
-            rec["tp_filtered"] = data_remaining[
-                (data_remaining["tag"] == "TP") & (data_remaining[f] <= q)].shape[0]
-            rec["fn"] = fns + rec["tp_filtered"] + strelka_f_tps
-            rec["fp_filtered"] = data_remaining[(data_remaining["tag"] == "FP") & (
-                data_remaining[f] <= q)].shape[0] + strelka_f_fps
-
-            try:
-                rec["recall"] = rec["tp"] / float(rec["tp"] + rec["fn"])
-            except:
-                rec["recall"] = None
-            try:
-                rec["precision"] = rec["tp"] / float(rec["tp"] + rec["fp"])
-            except:
-                rec["precision"] = None
-            result.append(rec)
-
-            counter += 1
-            if counter % 10 == 0:
-                print "Processed %i / %i qual values for %s" % (counter, len(qual_vals), f)
-
-    pandas.DataFrame(result, columns=[
+        # P/R counts for all quality thresholds at once from the sorted quality values of each tag:
+        thresholds = numpy.asarray(qual_vals[:-1])
+        tp, tp_filtered = countAboveThresholds(data_remaining[data_remaining["tag"] == "TP"][f].values, thresholds)
+        fp, fp_filtered = countAboveThresholds(data_remaining[data_remaining["tag"] == "FP"][f].values, thresholds)
+        fn = fns + tp_filtered + strelka_f_tps
+        fp_filtered = fp_filtered + strelka_f_fps
+
+        result.append(pandas.DataFrame({
+            "field": f,
+            "qual": thresholds,
+            "tp": tp,
+            "fp": fp,
+            "fn": fn,
+            "tp_filtered": tp_filtered,
+            "fp_filtered": fp_filtered,
+            "precision": ratioOrNaN(tp, tp + fp),
+            "recall": ratioOrNaN(tp, tp + fn)}))
+
+    pandas.concat(result, ignore_index=True)[[
         "field", "qual", "tp", "fp", "fn",
         "tp_filtered", "fp_filtered", "precision", "recall"]
-    ).to_csv(args.output)
+    ].to_csv(args.output)
 
 
 if __name__ == '__main__':
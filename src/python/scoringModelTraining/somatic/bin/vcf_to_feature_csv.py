@@ -25,6 +25,7 @@ truth VCF and FP / ambiguous region bed files.
 
 __author__ = "Peter Krusche <pkrusche@illumina.com>"
 
+import multiprocessing
 import os
 import sys
 
@@ -81,17 +82,29 @@ def parseArgs():
 
 
 
+def collectFeatures(featureSetName, vcfname):
+    """
+    Return the feature table of the named feature set for the given VCF
+    """
+    return evs.features.FeatureSet.make(featureSetName).collect(vcfname)
+
+
+
 def main():
     args = parseArgs()
 
-    fset = evs.features.FeatureSet.make(args.features)
+    if args.truth:
+        # collect the truth alleles in a second process while the input VCF is parsed
+        truthPool = multiprocessing.Pool(1)
+        truthResult = truthPool.apply_async(collectFeatures, ("posandalleles", args.truth))
 
-    featuretable = fset.collect(args.input[0])
+    featuretable = collectFeatures(args.features, args.input[0])
     featuretable["tag"] = "FP" # If no truth set is specified, label all variants as FP. Useful for normal-normal.
 
     if args.truth:
-        fset2 = evs.features.FeatureSet.make("posandalleles")
-        truth_alleles = fset2.collect(args.truth)
+        truth_alleles = truthResult.get()
+        truthPool.close()
+        truthPool.join()
         truth_alleles["tag"] = "TP"
         featuretable = pandas.merge(featuretable, truth_alleles, how="outer", on=["CHROM", "POS", "REF", "ALT"],
                                     suffixes=(".query", ".truth"))
@@ -17,12 +17,39 @@
 #
 #
 
+import itertools
+import operator
+import re
+import sys
+
+import numpy
 import pandas
 
 from evs.tools.vcf import openMaybeGzip, VCFID
 from . import FeatureSet
 
 
+NUCLEOTIDES = frozenset(["A", "C", "G", "T", "N"])
+
+# variant type of the records described by each feature label header key
+HEADER_KEY_TYPES = {
+    "snv_scoring_features": "snv",
+    "indel_scoring_features": "indel",
+}
+
+# matches any feature label header line, captures the key and the label list
+HEADER_KEY_PATTERN = re.compile(r"##(%s)=(\S+)" % "|".join(HEADER_KEY_TYPES.keys()))
+
+EVSF_TAG = "EVSF="
+EVSF_INNER_TAG = ";" + EVSF_TAG
+
+# fixed VCF column access for the record loop, leading columns are only split
+# up to the last column read:
+getPositionFields = operator.itemgetter(VCFID.CHROM, VCFID.POS, VCFID.REF, VCFID.ALT)
+POSITION_SPLIT_COUNT = VCFID.ALT + 1
+FEATURE_SPLIT_COUNT = VCFID.INFO + 1
+
+
 class VcfFeatureSet(FeatureSet):
 
     def collectCore(self, vcfname, headerKey = None):
@@ -37,89 +64,187 @@ class VcfFeatureSet(FeatureSet):
             """
             Return True if nucString is a single nucleotide, False otherwise.
             """
-            return (nucString in ["A", "C", "G", "T", "N"])
+            return (nucString in NUCLEOTIDES)
 
 
 
-        def variantType(ref, alt):
+        def isSnvAlleles(alleles):
             """
-            Return 'snv' if ref and all alt alleles are single nucleotides,
-            otherwise return 'indel'
+            Return a boolean array which is True for each entry of alleles where
+            all comma-separated alleles are single nucleotides.
+
+            Allele strings are strongly repeated (particularly for SNVs), so each
+            distinct string is only classified once and the result mapped back onto
+            all records.
             """
-            if isNucleotide(ref) and all(isNucleotide(allele) for allele in alt.split(',')) :
-                return "snv"
-            return "indel"
+            codes, uniques = pandas.factorize(alleles)
+            isSnv = numpy.array([all(isNucleotide(allele) for allele in u.split(',')) for u in uniques], dtype=bool)
+            return isSnv[codes]
 
 
 
-        def processVariant(line, keyType, header_feature_labels):
+        def getFeatureString(info):
             """
-            Return a record with collected features for this variant
-            or None if the variant type does not match the key type.
+            Return the EVSF value from the INFO field string, or None if EVSF is not present
+
+            EVSF is searched for directly in the INFO string, without splitting
+            every INFO entry into key/value pairs.
             """
+            if info.startswith(EVSF_TAG) :
+                start = len(EVSF_TAG)
+            else :
+                start = info.find(EVSF_INNER_TAG)
+                if start < 0 : return None
+                start += len(EVSF_INNER_TAG)
+            end = info.find(";", start)
+            if end < 0 :
+                return info[start:].rstrip()
+            return info[start:end]
 
-            isHeaderKey = (header_feature_labels is not None)
-            word = line.strip().split('\t')
 
-            qrec = {
-                "CHROM": word[VCFID.CHROM],
-                "POS": int(word[VCFID.POS]),
-                "REF": word[VCFID.REF],
-                "ALT": word[VCFID.ALT],
-            }
 
-            if isHeaderKey :
-                if variantType(word[VCFID.REF], word[VCFID.ALT]) != keyType :
-                    return None
-                for ikv in word[VCFID.INFO].split(';') :
-                    iword = ikv.split("=",1)
-                    if iword[0] == "EVSF" :
-                        assert(len(iword) == 2)
-                        features = [float(f) for f in iword[1].split(',')]
-                        for i in range(len(features)) :
-                            qrec[header_feature_labels[i]] = features[i]
-            return qrec
+        def processVariant(line, header_feature_labels):
+            """
+            Return a (chrom, pos, ref, alt, featureString) tuple for this variant
+
+            pos is returned unconverted, all positions are converted to int32 in one
+            numpy call after parsing. featureString is the unparsed EVSF value, or None
+            if this is not present.
+            """
+
+            if header_feature_labels is None :
+                return getPositionFields(line.split('\t', POSITION_SPLIT_COUNT)) + (None,)
+
+            # INFO may still carry the line ending in a sites-only VCF:
+            word = line.split('\t', FEATURE_SPLIT_COUNT)
+            return getPositionFields(word) + (getFeatureString(word[VCFID.INFO]),)
+
+
+
+        def parseFeatures(featureStrings, isPresent, featureCount):
+            """
+            Convert the EVSF strings of all records into a (records x features) float array
+
+            All values are parsed by numpy in a single pass over the joined EVSF strings,
+            without creating a Python object per value. Records without EVSF (where
+            isPresent is False) are set to NaN.
+            """
+            features = numpy.full((len(featureStrings), featureCount), numpy.nan)
+            present = numpy.flatnonzero(isPresent)
+            if len(present) == 0 :
+                return features
+
+            # check the value count of each record, the total count alone can't detect
+            # records with too many and too few values offsetting each other:
+            presentStrings = featureStrings[present]
+            valueCounts = numpy.array([f.count(",") for f in presentStrings]) + 1
+            badCounts = numpy.flatnonzero(valueCounts != featureCount)
+            if len(badCounts) > 0 :
+                raise Exception("Unexpected number of EVSF values in record '%s', expected %i per record" %
+                                (presentStrings[badCounts[0]], featureCount))
+
+            # the joined parse below can't tell record boundaries apart, so it relies on the
+            # per-record count check above for alignment. fromstring stops at the first value
+            # it cannot parse, which is caught by the total size check. All values before
+            # the bad one were parsed, so values.size locates the offending record:
+            values = numpy.fromstring(",".join(presentStrings), dtype=numpy.float64, sep=",")
+            if values.size != len(present) * featureCount :
+                raise Exception("Malformed EVSF value in record '%s'" %
+                                presentStrings[values.size // featureCount])
+            features[present] = values.reshape(len(present), featureCount)
+            return features
 
 
 
         feature_labels = ["CHROM", "POS", "REF", "ALT"]
         header_feature_labels = None
 
-        records = []
+        # records are accumulated column-wise, chromosomes are stored as an
+        # index into chromNames:
+        chromNames = []
+        chromIndex = {}
+        chromCodes = []
+        positions = []
+        refs = []
+        alts = []
+        featureStrings = []
+
+        # REF and ALT values repeat heavily, all records share one string object
+        # per distinct allele value, so that only the distinct values are kept in memory:
+        alleleStrings = {}
+
+        lastChrom = None
+        lastChromCode = -1
 
-        isHeader = True
         isHeaderKey = (headerKey is not None)
         if isHeaderKey :
-            if headerKey == "snv_scoring_features" :
-                keyType = "snv"
-            elif headerKey == "indel_scoring_features" :
-                keyType = "indel"
-            else :
+            if headerKey not in HEADER_KEY_TYPES :
                 raise Exception("Unknown header key: '%s'" % headerKey)
+            keyType = HEADER_KEY_TYPES[headerKey]
         else :
             keyType = None
 
-        for line in openMaybeGzip(vcfname):
-            if isHeader :
-                if line[0] == "#" :
-                    if isHeaderKey and line.startswith("##") :
-                        word = line[2:].strip().split("=")
-                        if word[0] == headerKey :
-                            assert(header_feature_labels is None)
-                            header_feature_labels = word[1].split(",")
-                            assert(len(header_feature_labels) > 0)
-                    continue
-                else :
-                    if isHeaderKey :
-                        assert(header_feature_labels is not None)
-                    isHeader = False
-
-            qrec = processVariant(line, keyType, header_feature_labels)
-            if qrec is not None:
-                records.append(qrec)
+        # the header and the records are read in two consecutive loops over the same
+        # line iterator, so that the record loop has no per-line header test:
+        vcfLines = iter(openMaybeGzip(vcfname))
+        firstRecord = []
+        for line in vcfLines :
+            if line[0] != "#" :
+                firstRecord.append(line)
+                break
+            if isHeaderKey :
+                match = HEADER_KEY_PATTERN.match(line)
+                if (match is not None) and (match.group(1) == headerKey) :
+                    assert(header_feature_labels is None)
+                    header_feature_labels = match.group(2).split(",")
+                    assert(len(header_feature_labels) > 0)
+
+        if isHeaderKey and (len(firstRecord) > 0) :
+            assert(header_feature_labels is not None)
+
+        for line in itertools.chain(firstRecord, vcfLines) :
+            (chrom, pos, ref, alt, featureString) = processVariant(line, header_feature_labels)
+            if chrom != lastChrom :
+                # VCF records are grouped by chromosome, so this is only done once per chromosome
+                lastChromCode = chromIndex.setdefault(chrom, len(chromNames))
+                if lastChromCode == len(chromNames) :
+                    chromNames.append(chrom)
+                lastChrom = chrom
+            chromCodes.append(lastChromCode)
+            positions.append(pos)
+            refs.append(alleleStrings.setdefault(ref, ref))
+            alts.append(alleleStrings.setdefault(alt, alt))
+            featureStrings.append(featureString)
+
+        columns = {
+            "CHROM": pandas.Categorical.from_codes(numpy.array(chromCodes, dtype=numpy.int32), chromNames),
+            "POS": numpy.array(positions, dtype=numpy.int32),
+            "REF": numpy.array(refs, dtype=object),
+            "ALT": numpy.array(alts, dtype=object),
+        }
 
         cols = feature_labels
         if isHeaderKey :
-            cols += header_feature_labels
-
-        return pandas.DataFrame(records, columns=cols)
+            # filter out records of the other variant type
+            isSnv = isSnvAlleles(columns["REF"]) & isSnvAlleles(columns["ALT"])
+            isKeyType = isSnv if keyType == "snv" else ~isSnv
+            for label in feature_labels :
+                columns[label] = columns[label][isKeyType]
+            columns["CHROM"] = columns["CHROM"].remove_unused_categories()
+            featureStrings = numpy.array(featureStrings, dtype=object)[isKeyType]
+
+            isPresent = pandas.notnull(featureStrings)
+            missingCount = len(isPresent) - numpy.count_nonzero(isPresent)
+            if missingCount > 0 :
+                # report each affected chromosome once, from the distinct chromosome codes of the missing records
+                chroms = columns["CHROM"]
+                missingChroms = chroms.categories[numpy.unique(chroms.codes[~isPresent])]
+                print >> sys.stderr, ("Warning: %i of %i %s records in '%s' have no EVSF features, these are set to NaN. Chromosomes affected: %s" %
+                                      (missingCount, len(isPresent), keyType, vcfname, ",".join(missingChroms)))
+
+            features = parseFeatures(featureStrings, isPresent, len(header_feature_labels))
+            for i, label in enumerate(header_feature_labels) :
+                columns[label] = features[:, i]
+            cols = feature_labels + header_feature_labels
+
+        return pandas.DataFrame(columns, columns=cols)